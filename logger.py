@@ -1,5 +1,6 @@
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import MemoryHandler, RotatingFileHandler
 from pathlib import Path
 
 def get_logger(name: str, log_file: str, level: str = "INFO"):
@@ -24,6 +25,10 @@ def get_logger(name: str, log_file: str, level: str = "INFO"):
     fh.setFormatter(formatter)
     sh.setFormatter(formatter)
 
-    logger.addHandler(fh)
+    # Buffer file writes; flush every 1024 records, on ERROR, or at exit
+    mh = MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=fh, flushOnClose=True)
+    atexit.register(mh.flush)
+
+    logger.addHandler(mh)
     logger.addHandler(sh)
     return logger
@@ -1,27 +1,35 @@
 import os
 import sys
+import asyncio
 import yaml
 import argparse
 import json
+import atexit
+import threading
 from pathlib import Path
 from dotenv import load_dotenv
 from datetime import datetime
+from collections import OrderedDict
 
 from logger import get_logger
 from utils import (
     find_files, load_documents, split_documents,
     build_or_load_faiss, make_retriever, make_rag_chain,
-    extract_product_info, format_sources
+    extract_product_info, format_sources, split_query, merge_results
 )
 
 
 # ------------------------
 # Config & Env
 # ------------------------
+# libyaml's C parser when PyYAML was built with it, else the pure-Python one
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
 def load_config(config_path: str = "config.yaml") -> dict:
     try:
         with open(config_path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f)
+            return yaml.load(f, Loader=_YAML_LOADER)
     except FileNotFoundError:
         sys.exit(f"[ERROR] Config file not found: {config_path}")
     except yaml.YAMLError as e:
@@ -39,9 +47,64 @@ def parse_args():
 # ------------------------
 # Conversation History
 # ------------------------
+_FLUSH_INTERVAL = 0.5  # seconds between buffered history writes
+_ANSWER_CACHE_SIZE = 256
+
+_pending: list[dict] = []
+_pending_file: Path | None = None
+_flush_lock = threading.Lock()
+_flush_timer: threading.Timer | None = None
+_history_fp = None  # append handle kept open across flushes
+
+
+def _history_handle(path: Path):
+    """Return the persistent append handle for `path`, opening it on first use."""
+    global _history_fp
+    if _history_fp is None or _history_fp.name != str(path):
+        if _history_fp is not None:
+            _history_fp.close()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _history_fp = open(path, "a", encoding="utf-8", buffering=1 << 16)
+    return _history_fp
+
+
+def _reset_after_fork():
+    """Give a forked child its own lock and handle, and drop the parent's queued records."""
+    global _flush_lock, _flush_timer, _history_fp
+    _flush_lock = threading.Lock()
+    _flush_timer = None
+    _history_fp = None
+    _pending.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def flush_conversations():
+    """Write all buffered conversation records to disk in a single write."""
+    global _flush_timer
+    with _flush_lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        if not _pending or _pending_file is None:
+            return
+
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in _pending)
+        _pending.clear()
+
+        fp = _history_handle(_pending_file)
+        fp.write(data)
+        fp.flush()
+
+
+atexit.register(flush_conversations)
+
+
 def save_conversation(history_file: Path, query: str, answer: str, sources: list, product_info: dict):
-    """Append conversation data into a JSON log file."""
-    history_file.parent.mkdir(parents=True, exist_ok=True)
+    """Buffer one conversation record; it is appended to the JSONL log by the flusher."""
+    global _pending_file, _flush_timer
 
     record = {
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -51,19 +114,53 @@ def save_conversation(history_file: Path, query: str, answer: str, sources: list
         "products": product_info
     }
 
-    if history_file.exists():
+    if _pending_file is not None and _pending_file != history_file:
+        flush_conversations()
+
+    with _flush_lock:
+        _pending_file = history_file
+        _pending.append(record)
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(_FLUSH_INTERVAL, flush_conversations)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+
+def _reverse_lines(path: Path, block_size: int = 1 << 13):
+    """Yield lines of a file from last to first, reading fixed-size blocks backwards."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = b""
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + tail).split(b"\n")
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line
+        if tail.strip():
+            yield tail
+
+
+def read_history(history_file: Path, limit: int = 20) -> list:
+    """Return the last `limit` conversation records, oldest first."""
+    flush_conversations()
+    if not history_file.exists():
+        return []
+
+    records = []
+    for line in _reverse_lines(history_file):
+        if len(records) >= limit:
+            break
         try:
-            with open(history_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            data = []
-    else:
-        data = []
-
-    data.append(record)
-
-    with open(history_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+            records.append(json.loads(line.decode("utf-8")))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            continue
+    records.reverse()
+    return records
 
 
 # ------------------------
@@ -87,7 +184,7 @@ def main():
         config["index"]["rebuild"] = True
 
     logger = get_logger("RAG-App", config["logging"]["file"], config["logging"]["level"])
-    history_file = Path(config["logging"].get("history_file", "logs/history.json"))
+    history_file = Path(config["logging"].get("history_file", "logs/history.jsonl"))
 
     logger.info("🚀 Starting RAG pipeline...")
 
@@ -111,57 +208,92 @@ def main():
         logger.info(f"✅ Created {len(chunks)} chunks.")
 
     logger.info("🔍 Building/Loading FAISS index...")
-    vectorstore = build_or_load_faiss(
-        chunks, rebuild_index, index_path, config["models"]["embedding"]
+    vectorstore, shards = build_or_load_faiss(
+        chunks, rebuild_index, index_path, config["models"]["embedding"], config["index"]
     )
     logger.info("✅ Vectorstore ready")
+    if shards:
+        logger.info(f"✅ {len(shards)} category shards ready")
 
-    retriever = make_retriever(vectorstore, config["retriever"])
+    retriever = make_retriever(vectorstore, config["retriever"], shards)
     rag_chain = make_rag_chain(retriever, config["models"]["chat"])
 
+    # Exact-match cache for repeated questions (disabled with --rebuild).
+    # Keyed on the normalized text; the chain still sees the question as typed.
+    answer_cache: OrderedDict[str, dict] = OrderedDict()
+    cache_lock = threading.Lock()
+
+    def cached_invoke(q: str) -> dict:
+        key = q.strip().lower()
+        with cache_lock:
+            if key in answer_cache:
+                answer_cache.move_to_end(key)
+                return answer_cache[key]
+        result = rag_chain.invoke({"input": q})
+        with cache_lock:
+            answer_cache[key] = result
+            if len(answer_cache) > _ANSWER_CACHE_SIZE:
+                answer_cache.popitem(last=False)
+        return result
+
+    async def ask(query: str) -> dict:
+        """Answer each sub-question concurrently and merge the results."""
+        parts = split_query(query)
+        if args.rebuild:
+            results = await asyncio.gather(*(rag_chain.ainvoke({"input": p}) for p in parts))
+        else:
+            results = await asyncio.gather(*(asyncio.to_thread(cached_invoke, p) for p in parts))
+        return merge_results(query, results)
+
+    async def handle(query: str):
+        try:
+            logger.info(f"📝 New Query: {query}")
+            result = await ask(query)
+            ctx = result.get("context", [])
+            product_info = extract_product_info(ctx)
+
+            # Decide on answer
+            if product_info:
+                answer = "Product info extracted"
+                print("\n📦 Product Info:")
+                for product, entries in product_info.items():
+                    print(f" {product}")
+                    for e in entries:
+                        print(f"  - {e['source']}: {e['price']} ({e['discount']} → {e['discounted_price']})")
+            else:
+                answer = result.get("answer") or result.get("output") or str(result)
+                print("\n💡 Answer:", answer.strip())
+
+            sources = format_sources(ctx) if ctx else []
+            if sources:
+                print("\n📚 Sources:", sources)
+
+            # Save conversation history
+            save_conversation(history_file, query, answer, sources, product_info)
+            logger.info(f"💾 Queued query & response for {history_file}")
+
+        except Exception as e:
+            logger.exception(f"❌ Query failed: {e}")
+            print("[ERROR] Query failed. See logs for details.")
+
     logger.info("✅ RAG setup complete. Entering interactive mode.")
 
-    # Interactive Loop
+    # Interactive Loop (one event loop for the session: async LLM clients bind to it)
     try:
-        while True:
-            query = input("\n❓ Your question (type 'exit' to quit): ")
-            if query.lower() in ("exit", "quit"):
-                print("👋 Goodbye!")
-                logger.info("Application terminated by user")
-                break
-
-            try:
-                logger.info(f"📝 New Query: {query}")
-                result = rag_chain.invoke({"input": query})
-                ctx = result.get("context", [])
-                product_info = extract_product_info(ctx)
-
-                # Decide on answer
-                if product_info:
-                    answer = "Product info extracted"
-                    print("\n📦 Product Info:")
-                    for product, entries in product_info.items():
-                        print(f" {product}")
-                        for e in entries:
-                            print(f"  - {e['source']}: {e['price']} ({e['discount']} → {e['discounted_price']})")
-                else:
-                    answer = result.get("answer") or result.get("output") or str(result)
-                    print("\n💡 Answer:", answer.strip())
-
-                sources = format_sources(ctx) if ctx else []
-                if sources:
-                    print("\n📚 Sources:", sources)
-
-                # Save conversation history
-                save_conversation(history_file, query, answer, sources, product_info)
-                logger.info(f"💾 Saved query & response to {history_file}")
-
-            except Exception as e:
-                logger.exception(f"❌ Query failed: {e}")
-                print("[ERROR] Query failed. See logs for details.")
+        with asyncio.Runner() as runner:
+            while True:
+                query = input("\n❓ Your question (type 'exit' to quit): ")
+                if query.lower() in ("exit", "quit"):
+                    print("👋 Goodbye!")
+                    flush_conversations()
+                    logger.info("Application terminated by user")
+                    break
+
+                runner.run(handle(query))
 
     except KeyboardInterrupt:
         print("\n👋 Exiting gracefully...")
+        flush_conversations()
         logger.info("Interrupted by user")
 
 
@@ -1,33 +1,105 @@
+import csv
+import json
+import os
+import pickle
 import re
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
+import faiss
+import numpy as np
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import CSVLoader, TextLoader
+from langchain_community.document_loaders import TextLoader
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_groq import ChatGroq
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
 
+_PRICE_CLEAN = re.compile(r"[^\d.]")
+_QUERY_SPLIT = re.compile(r"(?<=[?;])\s+")
+_MAX_TRAIN = 100_000  # vectors sampled to train IVF/PQ indexes
+_EMBED_BATCH = 100    # texts per embed_documents request (Google API limit)
+_EMBED_WORKERS = 8
+_ROUTE_MIN_LEN = 3    # shorter category names never take over routing
+_ROUTE_STOPWORDS = frozenset({
+    "a", "an", "the", "and", "or", "of", "for", "in", "on", "to", "with", "by", "at", "is", "it",
+    "all", "any", "other", "others", "misc", "miscellaneous", "general", "none", "unknown", "na", "n/a",
+})
+
 def find_files(path: Path) -> list[Path]:
     """Find all supported files in directory (CSV, TXT)."""
-    exts = [".csv", ".txt"]
-    return [p for p in path.rglob("*") if p.is_file() and p.suffix.lower() in exts]
+    exts = (".csv", ".txt")
+    stack, out = [str(path)], []
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:  # missing or unreadable directory: skip it, as rglob did
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and entry.name.lower().endswith(exts):
+                    out.append(Path(entry.path))
+    return out
 
-def load_documents(paths: list[Path]) -> list[Document]:
-    """Load documents from CSV and TXT files."""
+def _load_csv(p: Path) -> list[Document]:
+    """Load a CSV, one Document per row in CSVLoader's 'column: value' format."""
     docs = []
-    for p in paths:
-        try:
-            if p.suffix.lower() == ".csv":
-                docs.extend(CSVLoader(str(p)).load())
-            elif p.suffix.lower() == ".txt":
-                docs.extend(TextLoader(str(p), encoding="utf-8").load())
-        except Exception as e:
-            print(f"[WARN] Failed to load {p}: {e}")
+    with open(p, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return docs
+        header = [h.strip() for h in header]
+        width = len(header)
+        cat_idx = next((j for j, h in enumerate(header) if h.lower() == "category"), None)
+        source = str(p)
+        for row in reader:
+            if not row:
+                continue
+            # Ragged rows render the way CSVLoader did: missing fields read
+            # "None", extra fields are appended as a "None: a,b" line.
+            values = [v.strip() for v in row[:width]] + ["None"] * (width - len(row))
+            text = "\n".join(f"{h}: {v}" for h, v in zip(header, values))
+            if len(row) > width:
+                text += "\nNone: " + ",".join(v.strip() for v in row[width:])
+            metadata = {"source": source, "row": len(docs)}
+            if cat_idx is not None and values[cat_idx] not in ("", "None"):
+                metadata["category"] = values[cat_idx]
+            docs.append(Document(page_content=text, metadata=metadata))
     return docs
 
+def _load_one(p: Path) -> list[Document]:
+    """Load a single CSV or TXT file; return [] on failure."""
+    try:
+        if p.suffix.lower() == ".csv":
+            return _load_csv(p)
+        elif p.suffix.lower() == ".txt":
+            return TextLoader(str(p), encoding="utf-8").load()
+    except Exception as e:
+        print(f"[WARN] Failed to load {p}: {e}")
+    return []
+
+def load_documents(paths: list[Path]) -> list[Document]:
+    """Load documents from CSV and TXT files in parallel."""
+    if not paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(32, len(paths))) as ex:
+        results = list(ex.map(_load_one, paths))
+    return list(chain.from_iterable(results))
+
 def split_documents(docs: list[Document], splitter_cfg: dict) -> list[Document]:
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=splitter_cfg["chunk_size"],
@@ -35,21 +107,204 @@ def split_documents(docs: list[Document], splitter_cfg: dict) -> list[Document]:
     )
     return splitter.split_documents(docs)
 
-def build_or_load_faiss(chunks, rebuild, index_path, embed_model):
-    """Build FAISS index or load existing one."""
-    embeddings = GoogleGenerativeAIEmbeddings(model=embed_model)
+@lru_cache(maxsize=4)
+def _get_embeddings(embed_model: str) -> GoogleGenerativeAIEmbeddings:
+    """Return a shared embeddings client per model name."""
+    return GoogleGenerativeAIEmbeddings(model=embed_model)
+
+def _embed_texts(embeddings, texts: list[str]) -> np.ndarray:
+    """Embed texts in batches of _EMBED_BATCH, sending batches concurrently."""
+    batches = [texts[i:i + _EMBED_BATCH] for i in range(0, len(texts), _EMBED_BATCH)]
+    with ThreadPoolExecutor(max_workers=_EMBED_WORKERS) as ex:
+        results = list(ex.map(embeddings.embed_documents, batches))
+    return np.asarray(list(chain.from_iterable(results)), dtype=np.float32)
+
+class _UnitQueryEmbeddings(Embeddings):
+    """Embeddings wrapper returning unit-length query vectors, so inner product == cosine."""
+
+    def __init__(self, base: Embeddings):
+        self.base = base
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.base.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        xq = np.asarray([self.base.embed_query(text)], dtype=np.float32)
+        faiss.normalize_L2(xq)
+        return xq[0].tolist()
+
+def _wrap_faiss(index, embeddings, docstore, index_to_docstore_id) -> FAISS:
+    """Wrap a raw index in a LangChain store, scoring to match the index metric."""
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return FAISS(
+            embedding_function=_UnitQueryEmbeddings(embeddings),
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            relevance_score_fn=lambda score: score,  # unit vectors: score is already cosine
+        )
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+    )
+
+def _build_faiss(chunks: list[Document], xb: np.ndarray, embeddings, factory: str) -> FAISS:
+    """Add unit-length chunk vectors to a cosine FAISS index created from a factory string, e.g. 'HNSW32' or 'IVF1024,PQ32'."""
+    index = faiss.index_factory(xb.shape[1], factory, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        sample = xb
+        if len(xb) > _MAX_TRAIN:
+            sample = xb[np.random.default_rng(0).choice(len(xb), _MAX_TRAIN, replace=False)]
+        index.train(sample)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()  # MMR search needs reconstruct()
+    index.add(xb)
+
+    ids = [str(uuid.uuid4()) for _ in chunks]
+    return _wrap_faiss(index, embeddings, InMemoryDocstore(dict(zip(ids, chunks))), dict(enumerate(ids)))
+
+def _load_faiss(index_path: Path, embeddings, mmap: bool) -> FAISS:
+    """Load a saved index; with mmap the stored codes stay file-backed instead of being read into RAM.
+
+    IO_FLAG_MMAP_IFC maps the flat codes of Flat, HNSW and IVF indexes alike (an
+    HNSW graph is still loaded); IO_FLAG_MMAP would only cover IVF inverted lists.
+    """
+    flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    index = faiss.read_index(str(index_path / "index.faiss"), flags)
+    with open(index_path / "index.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return _wrap_faiss(index, embeddings, docstore, index_to_docstore_id)
+
+@lru_cache(maxsize=1)
+def _gpu_resources():
+    return faiss.StandardGpuResources()
+
+def _move_to_gpu(vs: FAISS) -> None:
+    """Clone the index onto GPU 0; keep the CPU index if its type has no GPU version."""
+    try:
+        vs.index = faiss.index_cpu_to_gpu(_gpu_resources(), 0, vs.index)
+    except RuntimeError as e:  # e.g. HNSW has no GPU implementation
+        print(f"[WARN] Index type not supported on GPU, using CPU index (try an IVF/PQ factory): {e}")
+
+def _shard_key(value: str) -> str:
+    return " ".join(str(value).split()).lower()
+
+def _build_shards(chunks: list[Document], xb: np.ndarray, embeddings, shard_path: Path, index_cfg: dict) -> dict[str, FAISS]:
+    """Build and save one index per value of metadata[shard_by], reusing the vectors already computed for the global index."""
+    key = index_cfg["shard_by"]
+    groups = {}
+    for i, c in enumerate(chunks):
+        value = c.metadata.get(key)
+        if value:
+            groups.setdefault(_shard_key(value), []).append(i)  # "Home" and "home" share a shard
+
+    shard_path.mkdir(parents=True)
+    names, shards = {}, {}
+    for n, (value, rows) in enumerate(groups.items()):
+        names[value] = f"{n:03d}"
+        vs = _build_faiss([chunks[i] for i in rows], xb[rows], embeddings, index_cfg.get("shard_factory", "Flat"))
+        vs.save_local(str(shard_path / names[value]))
+        shards[value] = vs
+    (shard_path / "shards.json").write_text(json.dumps(names, ensure_ascii=False), encoding="utf-8")
+    return shards
+
+def _load_shards(shard_path: Path, embeddings, index_cfg: dict) -> dict[str, FAISS]:
+    """Load the per-category shards saved next to the global index, if any."""
+    manifest = shard_path / "shards.json"
+    if not manifest.exists():
+        return {}
+    return {
+        value: _load_faiss(shard_path / dirname, embeddings, index_cfg.get("mmap", False))
+        for value, dirname in json.loads(manifest.read_text(encoding="utf-8")).items()
+    }
+
+def build_or_load_faiss(chunks, rebuild, index_path, embed_model, index_cfg: dict | None = None):
+    """Build FAISS index or load existing one; also returns the per-category shards (empty if sharding is off)."""
+    index_cfg = index_cfg or {}
+    embeddings = _get_embeddings(embed_model)
+    shards = {}
     if rebuild:
-        vs = FAISS.from_documents(chunks, embeddings)
+        xb = _embed_texts(embeddings, [c.page_content for c in chunks])
+        faiss.normalize_L2(xb)
+        vs = _build_faiss(chunks, xb, embeddings, index_cfg.get("factory", "Flat"))
         index_path.mkdir(parents=True, exist_ok=True)
-        vs.save_local(str(index_path))
-    return FAISS.load_local(str(index_path), embeddings, allow_dangerous_deserialization=True)
+        vs.save_local(str(index_path))  # keep using the in-memory store; no reload
+        # drop shards from the previous build even when sharding is now off, so a later load can't pick them up
+        shutil.rmtree(index_path / "shards", ignore_errors=True)
+        if index_cfg.get("shard_by"):
+            shards = _build_shards(chunks, xb, embeddings, index_path / "shards", index_cfg)
+    else:
+        vs = _load_faiss(index_path, embeddings, index_cfg.get("mmap", False))
+        if index_cfg.get("shard_by"):
+            shards = _load_shards(index_path / "shards", embeddings, index_cfg)
+    if index_cfg.get("gpu", False):
+        if faiss.get_num_gpus() == 0:
+            print("[WARN] index.gpu is set but no GPU is available; using CPU index")
+        else:
+            # after saving: GPU indexes cannot be written to disk
+            for store in (vs, *shards.values()):
+                _move_to_gpu(store)
+    return vs, shards
+
+class ShardedRetriever(BaseRetriever):
+    """Search only the shards of categories named in the query; fall back to the global index."""
+
+    default: BaseRetriever
+    shards: dict[str, list[BaseRetriever]]  # keyed by _shard_key(category)
+    pattern: re.Pattern
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        # Match on the normalised query so every hit is spelled exactly like a shard key.
+        hits = sorted(set(self.pattern.findall(_shard_key(query))))
+        config = {"callbacks": run_manager.get_child()}
+        if not hits:
+            return self.default.invoke(query, config=config)
+        seen, docs = set(), []
+        for name in hits:
+            for retriever in self.shards[name]:
+                for d in retriever.invoke(query, config=config):
+                    if d.page_content not in seen:
+                        seen.add(d.page_content)
+                        docs.append(d)
+        return docs
 
-def make_retriever(vectorstore: FAISS, retriever_cfg: dict):
+def _as_retriever(vectorstore: FAISS, retriever_cfg: dict):
+    index = vectorstore.index
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = retriever_cfg.get("nprobe", 16)
+    elif hasattr(index, "nprobe"):  # GPU IVF index
+        index.nprobe = retriever_cfg.get("nprobe", 16)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = retriever_cfg.get("ef_search", 64)
     return vectorstore.as_retriever(
         search_type=retriever_cfg.get("search_type", "similarity"),
         search_kwargs={"k": retriever_cfg.get("top_k", 5)}
     )
 
+def make_retriever(vectorstore: FAISS, retriever_cfg: dict, shards: dict[str, FAISS] | None = None):
+    retriever = _as_retriever(vectorstore, retriever_cfg)
+    min_len = retriever_cfg.get("route_min_len", _ROUTE_MIN_LEN)
+    stopwords = _ROUTE_STOPWORDS | {_shard_key(w) for w in retriever_cfg.get("route_stopwords", [])}
+    routable = {}
+    for name, vs in (shards or {}).items():
+        key = _shard_key(name)
+        if len(key) >= min_len and key not in stopwords:
+            routable.setdefault(key, []).append(_as_retriever(vs, retriever_cfg))
+    if not routable:
+        return retriever
+    names = sorted(routable, key=len, reverse=True)  # longest match wins, e.g. "home appliances" over "home"
+    alternatives = "|".join(r"\s+".join(map(re.escape, n.split())) for n in names)
+    return ShardedRetriever(
+        default=retriever,
+        shards=routable,
+        pattern=re.compile(r"(?<!\w)(" + alternatives + r")(?!\w)"),
+    )
+
 def make_rag_chain(retriever, chat_model: str):
     prompt = ChatPromptTemplate.from_messages([
         ("system", "You are a concise assistant. Answer only from the dataset context and cite sources."),
@@ -59,18 +314,24 @@ def make_rag_chain(retriever, chat_model: str):
     doc_chain = create_stuff_documents_chain(llm, prompt)
     return create_retrieval_chain(retriever, doc_chain)
 
-def calculate_discounted_price(price: float, discount: str) -> float:
-    """Handle discount values like '20%', '0.2', '20'."""
+def _discount_fraction(discount: str) -> float | None:
+    """Parse discount values like '20%', '0.2', '20' into a fraction; None if unparseable."""
     try:
         if "%" in discount:
-            discount_value = float(discount.strip('%')) / 100
-        else:
-            discount_value = float(discount)
-            if discount_value > 1:  # assume it's %
-                discount_value /= 100
-        return round(price - (price * discount_value), 2)
-    except Exception:
+            return float(discount.strip('%')) / 100
+        discount_value = float(discount)
+        if discount_value > 1:  # assume it's %
+            discount_value /= 100
+        return discount_value
+    except ValueError:
+        return None
+
+def calculate_discounted_price(price: float, discount: str) -> float:
+    """Handle discount values like '20%', '0.2', '20'."""
+    discount_value = _discount_fraction(discount)
+    if discount_value is None:
         return price
+    return round(price - (price * discount_value), 2)
 
 def extract_product_info(ctx: list[Document]) -> dict:
     """Parse structured product info if available."""
@@ -81,7 +342,7 @@ def extract_product_info(ctx: list[Document]) -> dict:
         if len(parts) >= 5:
             product, category, price, discount, source = parts[:5]
             try:
-                price = float(re.sub(r"[^\d.]", "", price))
+                price = float(_PRICE_CLEAN.sub("", price))
             except:
                 continue
             discounted_price = calculate_discounted_price(price, discount)
@@ -96,5 +357,22 @@ def extract_product_info(ctx: list[Document]) -> dict:
 
 def format_sources(ctx: list[Document]) -> str:
     """Return formatted sources list."""
-    sources = [d.metadata.get("source") or d.metadata.get("file_path") or "unknown" for d in ctx]
-    return ", ".join(sorted(set(sources)))
+    return ", ".join(sorted({d.metadata.get("source") or d.metadata.get("file_path") or "unknown" for d in ctx}))
+
+def split_query(query: str) -> list[str]:
+    """Split a multi-part question on '?' or ';' boundaries."""
+    parts = [p.strip(" ;") for p in _QUERY_SPLIT.split(query.strip())]
+    return [p for p in parts if p] or [query]
+
+def merge_results(query: str, results: list[dict]) -> dict:
+    """Combine sub-query results: answers joined, contexts de-duplicated in retrieval order."""
+    if len(results) == 1:
+        return results[0]
+    seen, context = set(), []
+    for r in results:
+        for d in r.get("context", []):
+            if d.page_content not in seen:
+                seen.add(d.page_content)
+                context.append(d)
+    answer = "\n\n".join(r["answer"].strip() for r in results if r.get("answer"))
+    return {"input": query, "context": context, "answer": answer}